@@ -5,9 +5,12 @@ import streamlit as st
 import pandas as pd
 import base64
 import re
+import secrets
 from llm.llm_factory import LLMFactory
+from llm.llm_gateway import LLMGatewayError, get_gateway_metrics
 from graph.eda_graph import create_eda_graph
-from tools.rag_tool import setup_vectorstore
+from graph.checkpoint import make_session_id, delete_session_checkpoints
+from tools.rag_tool import setup_vectorstore, knowledge_base_id
 from langchain_core.messages import AIMessage, HumanMessage
 from PIL import UnidentifiedImageError
 
@@ -22,6 +25,12 @@ def init_session_state():
         st.session_state.messages = []
     if "graph_runner" not in st.session_state:
         st.session_state.graph_runner = None
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = None
+    # Segredo aleatório da sessão do navegador, guardado apenas no servidor (nunca na URL):
+    # um link copiado ou outra aba não dá acesso aos checkpoints desta sessão.
+    if "session_secret" not in st.session_state:
+        st.session_state.session_secret = secrets.token_hex(16)
 
 init_session_state()
 
@@ -44,18 +53,39 @@ with st.sidebar:
     if llm_provider in ["GPT", "Gemini"]:
         api_key = st.text_input(f"Insira a chave de API do {llm_provider}", type="password", help="Não é obrigatório o uso de chave para o Gemini, o desenvolvedor já forneceu uma.")
 
+    speculative_mode = st.checkbox(
+        "Geração especulativa de código",
+        help="Gera vários scripts em paralelo para cada etapa e usa o primeiro que executar sem erro. Se todos falharem, o erro é devolvido ao modelo para correção. Reduz novas perguntas após falhas, ao custo de mais chamadas ao LLM. Apenas a geração é paralela: a execução dos candidatos é feita um por vez e um candidato já em execução não pode ser interrompido."
+    )
+    speculative_candidates, max_repair_attempts = 1, 0
+    if speculative_mode:
+        speculative_candidates = st.slider("Candidatos por etapa", min_value=2, max_value=4, value=3)
+        max_repair_attempts = st.slider("Rodadas de correção", min_value=0, max_value=3, value=1)
+
+    replay_saved_answers = st.checkbox(
+        "Reproduzir respostas salvas",
+        help="Se uma pergunta idêntica já tiver sido respondida nesta sessão, reproduz a resposta salva no checkpoint, sem chamar o LLM. Desmarcado, a pergunta é sempre analisada novamente."
+    )
+
     if st.button("🚀 Iniciar Agente"):
         if uploaded_csv is not None:
             with st.spinner("Processando arquivos e construindo o grafo..."):
                 try:
                     df = pd.read_csv(uploaded_csv)
+                    session_id = make_session_id(st.session_state.session_secret, uploaded_csv.getvalue(), llm_provider)
                     
+                    # A base de conhecimento é exclusiva da sessão; sem PDFs, o agente não faz recuperação
+                    knowledge_base = None
                     if uploaded_pdfs:
-                        setup_vectorstore(uploaded_pdfs)
+                        knowledge_base = setup_vectorstore(uploaded_pdfs, knowledge_base_id(session_id, uploaded_pdfs))
                         st.success("Base de conhecimento (RAG) criada com sucesso!")
                     
                     llm = LLMFactory.create_llm(llm_provider, api_key)
-                    st.session_state.graph_runner = create_eda_graph(llm, df)
+                    st.session_state.session_id = session_id
+                    st.session_state.graph_runner = create_eda_graph(
+                        llm, df, speculative_candidates, max_repair_attempts,
+                        session_id=session_id, knowledge_base=knowledge_base
+                    )
                     
                     st.session_state.messages = []
                     st.success(f"Agente inicializado com {llm_provider}. Pronto para análise!")
@@ -64,13 +94,65 @@ with st.sidebar:
         else:
             st.warning("Por favor, carregue um arquivo CSV para começar.")
 
+    if st.session_state.session_id and st.button(
+        "🗑️ Apagar checkpoints desta sessão",
+        help="Os checkpoints guardam em disco a pergunta, o histórico (texto), as primeiras linhas do CSV, o plano, o código, os resultados e a conclusão de cada pergunta."
+    ):
+        deleted = delete_session_checkpoints(st.session_state.session_id)
+        st.success(f"Checkpoints de {deleted} pergunta(s) apagados.")
+
+    with st.expander("📊 Métricas do Gateway LLM"):
+        st.caption("Contadores compartilhados por todas as sessões, por provedor.")
+        st.json(get_gateway_metrics())
+
 # --- ÁREA PRINCIPAL DO CHAT ---
+def to_chat_history(messages):
+    """
+    Converte as mensagens da interface em mensagens do LangChain, apenas com o texto.
+    Gráficos e detalhes ficam de fora, pois o histórico é salvo no checkpoint a cada pergunta.
+    """
+    history = []
+    for msg in messages:
+        if msg["role"] == "user":
+            history.append(HumanMessage(content=msg["content"]))
+        else:
+            history.append(AIMessage(content=msg["content"]))
+    return history
+
+def build_assistant_message(question, final_state):
+    """Monta a mensagem do assistente (conclusão, raciocínio e gráficos) a partir do estado final do grafo."""
+    conclusion = final_state.get("conclusion", "Não foi possível gerar uma conclusão.")
+    execution_details = {
+        "question": question,
+        "plan": final_state.get("plan", "Plano não disponível."),
+        "code": final_state.get("code_to_execute", "Código não disponível."),
+        "result": str(final_state.get("execution_result", "Resultado não disponível.")),
+        "context": final_state.get("retrieved_context", "")
+    }
+    images = [img.strip() for img in re.findall(r'\[PLOT_DATA:(.*?)\]', execution_details["result"]) if img.strip()]
+    return {"role": "assistant", "content": conclusion, "details": execution_details, "images": images}
+
+def rerun_from_checkpoint(index, question, rerun):
+    """Refaz apenas o executor ou apenas a conclusão de uma resposta, a partir do checkpoint salvo."""
+    with st.spinner("Refazendo a etapa a partir do checkpoint..."):
+        try:
+            final_state = st.session_state.graph_runner(question, [], rerun=rerun)
+        except (LLMGatewayError, ValueError) as e:
+            st.error(f"Não foi possível refazer a etapa: {e}")
+            return
+    st.session_state.messages[index] = build_assistant_message(question, final_state)
+    st.rerun()
+
 def display_chat_history():
-    for msg in st.session_state.messages:
+    for i, msg in enumerate(st.session_state.messages):
         with st.chat_message(msg["role"]):
             # Expander para detalhes de raciocínio
             if "details" in msg:
                 with st.expander("Ver Raciocínio do Agente."):
+                    if msg["details"].get("context"):
+                        st.markdown("##### Contexto Recuperado (RAG)")
+                        st.code(msg["details"]["context"], language="text")
+
                     st.markdown("##### Plano de Análise")
                     st.markdown(msg["details"]["plan"], unsafe_allow_html=True)
 
@@ -82,13 +164,21 @@ def display_chat_history():
                     raw_result = re.sub(r'\[PLOT_DATA:.*?\]', '[Visualização gerada com sucesso]', msg["details"]["result"])
                     # st.text(raw_result)
                     st.code(raw_result, language="text")
+
+                    question = msg["details"].get("question")
+                    if question:
+                        col_executor, col_concluder = st.columns(2)
+                        if col_executor.button("🔁 Reexecutar código", key=f"rerun_executor_{i}", help="Executa novamente o código salvo, sem gerá-lo de novo, e refaz a conclusão."):
+                            rerun_from_checkpoint(i, question, "executor")
+                        if col_concluder.button("📝 Refazer conclusão", key=f"rerun_concluder_{i}", help="Gera novamente apenas a conclusão, a partir dos resultados salvos."):
+                            rerun_from_checkpoint(i, question, "concluder")
             # Resposta do modelo
             st.markdown(msg["content"])
             
-            # Gráfico gerado
-            if "image" in msg and msg["image"]:
+            # Gráficos gerados (um por etapa do plano que produziu visualização)
+            for image in msg.get("images", []):
                 try:
-                    st.image(base64.b64decode(msg["image"]))
+                    st.image(base64.b64decode(image))
                 except Exception as e:
                     st.warning(f"Falha ao renderizar imagem: {e}")
 
@@ -112,21 +202,18 @@ if st.session_state.graph_runner:
 
                 # result_text = str(final_state.get("execution_result", ""))
 
-                final_state = st.session_state.graph_runner(prompt, st.session_state.get("messages", []))
-
-                conclusion = final_state.get("conclusion", "Não foi possível gerar uma conclusão.")
-
-                execution_details = {
-                    "plan": final_state.get("plan", "Plano não disponível."),
-                    "code": final_state.get("code_to_execute", "Código não disponível."),
-                    "result": str(final_state.get("execution_result", "Resultado não disponível."))
-                }
+                try:
+                    final_state = st.session_state.graph_runner(
+                        prompt, to_chat_history(st.session_state.messages[:-1]), replay=replay_saved_answers
+                    )
+                except LLMGatewayError as e:
+                    st.error(f"O provedor de IA não conseguiu atender à requisição. Envie a mesma pergunta novamente para retomar a partir da etapa que falhou.\n\n{e}")
+                    st.stop()
 
-                result_text = execution_details["result"]
-                plot_match = re.search(r'\[PLOT_DATA:(.*?)\]', result_text)
+                assistant_message = build_assistant_message(prompt, final_state)
+                conclusion = assistant_message["content"]
 
                 # assistant_message = {"role": "assistant", "content": conclusion, "lc_message": AIMessage(content=conclusion)}
-                assistant_message = {"role": "assistant", "content": conclusion, "details": execution_details}
                 
                 # if plot_match:
                 #     img_data = plot_match.group(1)
@@ -136,16 +223,10 @@ if st.session_state.graph_runner:
                 # else:
                 #     st.markdown(conclusion)
                 st.markdown(conclusion)
-                if plot_match:
-                    img_data = plot_match.group(1).strip()
-                    assistant_message["image"] = img_data
+                for img_data in assistant_message["images"]:
                     # Tenta renderizar a imagem, tratando possíveis erros
                     try:
-                        # Verifica se img_data não está vazio antes de tentar decodificar
-                        if img_data:
-                            st.image(base64.b64decode(img_data))
-                        else:
-                            st.warning("O agente indicou a geração de um gráfico, mas os dados da imagem estão ausentes.")
+                        st.image(base64.b64decode(img_data))
                     except (base64.binascii.Error, UnidentifiedImageError):
                         st.warning("Não foi possível renderizar a visualização. O agente pode ter retornado um resultado textual em vez de um gráfico.")
                 
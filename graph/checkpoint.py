@@ -0,0 +1,57 @@
+# /graph/checkpoint.py
+
+import hashlib
+import os
+import sqlite3
+import threading
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+# Banco SQLite local onde o estado de cada execução do grafo é salvo após cada nó.
+# Ele guarda, por pergunta: a pergunta, o histórico da conversa (apenas o texto das mensagens),
+# as primeiras linhas do CSV, o contexto recuperado dos PDFs, o plano, o código, os resultados
+# (incluindo gráficos em base64) e a conclusão. Nada é removido automaticamente: use
+# `delete_session_checkpoints` ou apague o arquivo para descartar esses dados.
+CHECKPOINT_DB_PATH = os.getenv("EDA_CHECKPOINT_DB", "checkpoints.sqlite")
+
+_checkpointer = None
+_checkpointer_lock = threading.Lock()
+
+def get_checkpointer() -> SqliteSaver:
+    """
+    Retorna o checkpointer SQLite compartilhado pelo processo, criando-o na primeira chamada.
+    A conexão é usada pelas threads do Streamlit e dos ramos paralelos; o `SqliteSaver` serializa o acesso.
+    """
+    global _checkpointer
+    with _checkpointer_lock:
+        if _checkpointer is None:
+            conn = sqlite3.connect(CHECKPOINT_DB_PATH, check_same_thread=False)
+            _checkpointer = SqliteSaver(conn)
+        return _checkpointer
+
+def make_thread_id(session_id: str, question: str) -> str:
+    """Identificador do checkpoint de uma pergunta dentro de uma sessão do agente."""
+    question_hash = hashlib.sha256(question.strip().encode("utf-8")).hexdigest()[:16]
+    return f"{session_id}:{question_hash}"
+
+def make_session_id(session_secret: str, csv_bytes: bytes, provider: str) -> str:
+    """
+    Identificador da sessão do agente: continua o mesmo após um novo "Iniciar Agente", desde que
+    a sessão do navegador (`session_secret`, um segredo aleatório que nunca sai do servidor),
+    o CSV e o provedor sejam os mesmos.
+    """
+    csv_hash = hashlib.sha256(csv_bytes).hexdigest()[:16]
+    return f"{session_secret}:{csv_hash}:{provider.upper()}"
+
+def delete_session_checkpoints(session_id: str) -> int:
+    """Apaga os checkpoints de todas as perguntas de uma sessão. Retorna quantas perguntas foram apagadas."""
+    checkpointer = get_checkpointer()
+    prefix = f"{session_id}:"
+    with checkpointer.cursor() as cur:
+        cur.execute(
+            "SELECT DISTINCT thread_id FROM checkpoints WHERE substr(thread_id, 1, ?) = ?",
+            (len(prefix), prefix)
+        )
+        thread_ids = [row[0] for row in cur.fetchall()]
+    for thread_id in thread_ids:
+        checkpointer.delete_thread(thread_id)
+    return len(thread_ids)
@@ -2,23 +2,102 @@
 
 from langchain_core.prompts import PromptTemplate
 from .state import EdaGraphState
+from .speculative import generate_and_execute
+from .checkpoint import get_checkpointer, make_thread_id
 from tools.pandas_tool import PythonExecutorTool
-from tools.rag_tool import knowledge_base_search
-from langgraph.graph import StateGraph, END
+from tools.rag_tool import is_retrieval_relevant, hybrid_search, format_context
+from langgraph.graph import StateGraph, START, END
+from langgraph.types import Send
 from langchain_core.messages import HumanMessage
 import pandas as pd
+import json
 import re
+import uuid
+
+# Limite de caracteres do resultado de uma etapa repassado às etapas que dependem dela
+MAX_DEPENDENCY_RESULT_CHARS = 2000
 
 # --- DEFINIÇÃO DOS NÓS DO GRAFO ---
 
+def profile_node(state: EdaGraphState, df: pd.DataFrame):
+    """Nó que extrai o perfil do dataset (cabeçalho do DataFrame) usado como contexto pelo LLM."""
+    return {"df_head": df.head().to_string()}
+
+def retrieval_node(state: EdaGraphState, knowledge_base: str):
+    """
+    Nó que busca contexto nos PDFs enviados nesta sessão (`knowledge_base`), em paralelo ao perfil do dataset.
+    Uma verificação barata (BM25 local) pula a busca quando a pergunta não tem relação com a base,
+    de modo que o ramo termina quase instantaneamente quando a recuperação não é necessária.
+    """
+    try:
+        if not is_retrieval_relevant(state["question"], knowledge_base):
+            return {"retrieved_context": ""}
+        return {"retrieved_context": format_context(hybrid_search(state["question"], knowledge_base))}
+    except Exception:
+        # A recuperação é um complemento: uma falha na base de conhecimento não deve interromper a análise
+        return {"retrieved_context": ""}
+
+def _parse_plan_steps(raw_plan: str) -> list:
+    """
+    Converte a resposta do planejador em uma lista de etapas com dependências.
+    As dependências só podem apontar para etapas anteriores, o que garante um DAG sem ciclos.
+    Se a resposta não for um JSON válido, o plano inteiro vira uma única etapa.
+    """
+    match = re.search(r"\{.*\}", raw_plan, re.DOTALL)
+    try:
+        data = json.loads(match.group(0)) if match else {}
+    except json.JSONDecodeError:
+        data = {}
+    raw_steps = data.get("etapas", []) if isinstance(data, dict) else []
+
+    steps = []
+    id_map = {}  # id informado pelo LLM -> id sequencial
+    for raw_step in raw_steps if isinstance(raw_steps, list) else []:
+        if not isinstance(raw_step, dict) or not str(raw_step.get("descricao", "")).strip():
+            continue
+        step_id = len(steps) + 1
+        raw_deps = raw_step.get("depende_de") or []
+        if not isinstance(raw_deps, list):
+            raw_deps = [raw_deps]
+        depends_on = sorted({id_map[str(dep)] for dep in raw_deps if str(dep) in id_map})
+        id_map[str(raw_step.get("id", step_id))] = step_id
+        steps.append({
+            "id": step_id,
+            "description": str(raw_step["descricao"]).strip(),
+            "depends_on": depends_on,
+        })
+
+    if not steps:
+        steps = [{"id": 1, "description": raw_plan.strip(), "depends_on": []}]
+    return steps
+
+def _format_plan(steps: list) -> str:
+    """Gera a versão textual do plano, exibida ao usuário e usada na conclusão."""
+    lines = []
+    for step in steps:
+        line = f"{step['id']}. {step['description']}"
+        if step["depends_on"]:
+            line += f" (depende de: {', '.join(str(dep) for dep in step['depends_on'])})"
+        lines.append(line)
+    return "\n".join(lines)
+
 def plan_node(state: EdaGraphState, llm):
-    """Nó que gera um plano de análise com base na pergunta."""
+    """Nó que gera um plano de análise estruturado (DAG de etapas) com base na pergunta."""
     prompt = PromptTemplate.from_template(
         """Você é um planejador especialista em análise de dados. Dada a pergunta do usuário,
         o histórico da nossa conversa anterior e as primeiras linhas de um DataFrame,
         crie um plano passo a passo conciso para responder à pergunta.
         Leve em conta as análises já realizadas no histórico para evitar repetições.
 
+        Cada etapa será convertida em um script Python próprio e as etapas independentes serão executadas em paralelo.
+        - Separe em etapas diferentes as sub-análises que não dependem umas das outras (ex: distribuições e correlações).
+        - Só declare uma dependência quando a etapa realmente precisar do resultado de uma etapa anterior.
+        - Não crie etapas apenas para carregar ou inspecionar os dados; o DataFrame já está carregado.
+        - Perguntas simples devem ter uma única etapa.
+
+        Responda APENAS com um JSON no formato:
+        {{"etapas": [{{"id": 1, "descricao": "...", "depende_de": []}}, {{"id": 2, "descricao": "...", "depende_de": [1]}}]}}
+
         Histórico da Conversa:
         {chat_history}
 
@@ -26,15 +105,20 @@ def plan_node(state: EdaGraphState, llm):
         Cabeçalho do DataFrame:
         {df_head}
 
-        Plano:"""
+        Contexto da Base de Conhecimento (documentos do usuário; pode estar vazio):
+        {knowledge_context}
+
+        Plano (JSON):"""
     )
     chain = prompt | llm
-    plan = chain.invoke({
+    raw_plan = chain.invoke({
         "question": state["question"],
         "df_head": state["df_head"],
+        "knowledge_context": state.get("retrieved_context", ""),
         "chat_history": state["chat_history"]  # <-- Adicione esta linha
     }).content
-    return {"plan": plan}
+    plan_steps = _parse_plan_steps(raw_plan)
+    return {"plan": _format_plan(plan_steps), "plan_steps": plan_steps}
 
 def code_generation_node(state: EdaGraphState, llm):
     """Nó que gera código Python para executar o plano."""
@@ -78,13 +162,20 @@ def code_generation_node(state: EdaGraphState, llm):
 
         Cabeçalho do DataFrame:
         {df_head}
+
+        {feedback}
         
         **--- SCRIPT PYTHON ---**
         Gere um único bloco de código Python que implemente o plano completo, seguindo TODAS as regras acima. O código deve ser limpo, sem comentários ou markdown.
         """
     )
     chain = prompt | llm
-    code = chain.invoke({"plan": state["plan"], "df_head": state["df_head"]}).content
+    code = chain.invoke({
+        "plan": state["plan"],
+        "df_head": state["df_head"],
+        # Instruções extras da geração especulativa (diversificação de candidatos ou correção de erro)
+        "feedback": state.get("feedback", "")
+    }).content
     # Limpa o código de blocos de markdown
     match = re.search(r"```python\n(.*?)\n```", code, re.DOTALL)
     if match:
@@ -100,6 +191,89 @@ def code_execution_node(state: EdaGraphState, pandas_tool):
     result = pandas_tool.invoke({"code": code})
     return {"execution_result": result}
 
+def step_worker_node(state: dict, llm, pandas_tool, speculative_candidates: int = 1, max_repair_attempts: int = 0):
+    """
+    Nó executado em um ramo paralelo (fan-out): gera e executa o código de uma única etapa do plano.
+    Recebe, via `Send`, a etapa, o cabeçalho do DataFrame e os resultados das etapas das quais depende.
+    Com a geração especulativa, vários candidatos são gerados e executados e o primeiro sucesso é usado.
+    """
+    step = state["step"]
+    step_plan = step["description"]
+    if state["dependency_results"]:
+        step_plan += "\n\nResultados das etapas anteriores das quais esta etapa depende:\n"
+        step_plan += "\n\n".join(state["dependency_results"])
+
+    attempt = generate_and_execute(
+        generate=lambda feedback: code_generation_node(
+            {"plan": step_plan, "df_head": state["df_head"], "feedback": feedback}, llm
+        )["code_to_execute"],
+        execute=lambda code: code_execution_node({"code_to_execute": code}, pandas_tool)["execution_result"],
+        candidates=speculative_candidates,
+        max_repairs=max_repair_attempts,
+    )
+    return {"step_results": [{
+        "id": step["id"],
+        "description": step["description"],
+        "code": attempt["code"],
+        "result": attempt["result"],
+    }]}
+
+def dispatch_steps(state: EdaGraphState):
+    """
+    Aresta condicional que distribui as etapas prontas (dependências satisfeitas) em ramos paralelos.
+    Quando não há mais etapas pendentes, segue para a conclusão.
+    """
+    results_by_id = {r["id"]: r for r in state.get("step_results") or []}
+    ready = [
+        step for step in state["plan_steps"]
+        if step["id"] not in results_by_id and all(dep in results_by_id for dep in step["depends_on"])
+    ]
+    if not ready:
+        return "concluder"
+
+    sends = []
+    for step in ready:
+        dependency_results = []
+        for dep in step["depends_on"]:
+            # Remove os dados de imagem para não inflar o prompt
+            dep_result = re.sub(r"\[PLOT_DATA:.*?\]", "[Visualização gerada]", results_by_id[dep]["result"], flags=re.DOTALL)
+            dependency_results.append(f"Etapa {dep} ({results_by_id[dep]['description']}):\n{dep_result[:MAX_DEPENDENCY_RESULT_CHARS]}")
+        sends.append(Send("step_worker", {
+            "step": step,
+            "df_head": state["df_head"],
+            "dependency_results": dependency_results,
+        }))
+    return sends
+
+def merge_steps_node(state: EdaGraphState):
+    """Nó que junta o código e os resultados de todas as etapas já executadas, na ordem do plano."""
+    results = sorted(state.get("step_results") or [], key=lambda r: r["id"])
+    code = "\n\n".join(
+        f"# Etapa {r['id']}: {' '.join(r['description'].split())}\n{r['code']}" for r in results
+    )
+    result = "\n\n".join(f"Etapa {r['id']}: {r['description']}\n{r['result']}" for r in results)
+    return {"code_to_execute": code, "execution_result": result}
+
+def reexecute_steps_node(state: EdaGraphState, pandas_tool):
+    """Nó que reexecuta o código já gerado de todas as etapas, sem chamar o LLM."""
+    step_results = []
+    for r in state.get("step_results") or []:
+        result = code_execution_node({"code_to_execute": r["code"]}, pandas_tool)["execution_result"]
+        step_results.append({**r, "result": result})
+    return {"step_results": step_results}
+
+def route_entry(state: EdaGraphState, entry_nodes: list):
+    """
+    Define o ponto de entrada do grafo. Uma execução nova começa pelos `entry_nodes` (o perfil do
+    dataset e, se a sessão tiver PDFs, a recuperação de contexto, em paralelo); um `rerun` refaz
+    apenas o executor (e a conclusão) ou apenas a conclusão, reaproveitando o checkpoint.
+    """
+    if state.get("rerun") == "executor":
+        return "code_executor"
+    if state.get("rerun") == "concluder":
+        return "concluder"
+    return entry_nodes
+
 def conclusion_node(state: EdaGraphState, llm):
     """Nó que gera a conclusão final para o usuário."""
     prompt = PromptTemplate.from_template(
@@ -114,6 +288,8 @@ def conclusion_node(state: EdaGraphState, llm):
         Pergunta Original: {question}
         Plano Executado: {plan}
         Resultado da Execução: {result}
+        Contexto da Base de Conhecimento (cite a fonte se usá-lo; pode estar vazio):
+        {knowledge_context}
 
         Conclusão Final:"""
     )
@@ -122,42 +298,95 @@ def conclusion_node(state: EdaGraphState, llm):
         "question": state["question"],
         "plan": state["plan"],
         "result": state["execution_result"],
+        "knowledge_context": state.get("retrieved_context", ""),
         "chat_history": state["chat_history"]  # <-- Adicione esta linha
     }).content
     return {"conclusion": conclusion}
 
-def create_eda_graph(llm: object, df: pd.DataFrame):
+def create_eda_graph(llm: object, df: pd.DataFrame, speculative_candidates: int = 1, max_repair_attempts: int = 0, session_id: str = None, knowledge_base: str = None):
+    """
+    Cria o grafo de análise e devolve a função que o executa.
+    O estado é salvo em um checkpoint SQLite por sessão e pergunta, o que permite retomar
+    uma execução a partir do nó que falhou e reproduzir respostas já concluídas sem chamar o LLM.
+
+    Args:
+        llm: O modelo usado por todos os nós.
+        df: O DataFrame analisado.
+        speculative_candidates: Scripts gerados em paralelo por etapa (1 desativa a geração especulativa).
+        max_repair_attempts: Rodadas de correção, com o erro devolvido ao gerador, quando todos os candidatos falham.
+        session_id: Identificador da sessão usado nos checkpoints (gerado automaticamente se omitido).
+        knowledge_base: Coleção com os PDFs da sessão (ver `setup_vectorstore`). Sem ela, o ramo de recuperação não é criado.
+    """
+    session_id = session_id or uuid.uuid4().hex
     pandas_tool = PythonExecutorTool(df=df)
-    
-    # RAG tool accessible by the agent.
-    tools = [pandas_tool, knowledge_base_search]
 
     # Define o workflow
     workflow = StateGraph(EdaGraphState)
 
     # Adiciona os nós
+    workflow.add_node("profiler", lambda state: profile_node(state, df))
+    entry_nodes = ["profiler"]
+    if knowledge_base:
+        workflow.add_node("retriever", lambda state: retrieval_node(state, knowledge_base))
+        entry_nodes.append("retriever")
     workflow.add_node("planner", lambda state: plan_node(state, llm))
-    workflow.add_node("code_generator", lambda state: code_generation_node(state, llm))
-    workflow.add_node("code_executor", lambda state: code_execution_node(state, pandas_tool))
+    workflow.add_node("step_worker", lambda state: step_worker_node(
+        state, llm, pandas_tool, speculative_candidates, max_repair_attempts
+    ))
+    workflow.add_node("step_merger", merge_steps_node)
+    workflow.add_node("code_executor", lambda state: reexecute_steps_node(state, pandas_tool))
     workflow.add_node("concluder", lambda state: conclusion_node(state, llm))
     
     # Define as arestas (o fluxo)
-    workflow.set_entry_point("planner")
-    workflow.add_edge("planner", "code_generator")
-    workflow.add_edge("code_generator", "code_executor")
-    workflow.add_edge("code_executor", "concluder")
+    # O perfil do dataset e a recuperação de contexto rodam em paralelo; o planejador espera pelos dois.
+    workflow.add_conditional_edges(
+        START, lambda state: route_entry(state, entry_nodes), entry_nodes + ["code_executor", "concluder"]
+    )
+    workflow.add_edge(entry_nodes, "planner")
+    # Cada "onda" de etapas independentes roda em paralelo; o merger junta os resultados
+    # e libera as etapas que dependiam delas, até não restar nenhuma pendente.
+    workflow.add_conditional_edges("planner", dispatch_steps, ["step_worker", "concluder"])
+    workflow.add_edge("step_worker", "step_merger")
+    workflow.add_conditional_edges("step_merger", dispatch_steps, ["step_worker", "concluder"])
+    workflow.add_edge("code_executor", "step_merger")
     workflow.add_edge("concluder", END)
 
-    # Compila o grafo em um objeto executável
-    app = workflow.compile()
+    # Compila o grafo em um objeto executável, salvando o estado após cada nó
+    app = workflow.compile(checkpointer=get_checkpointer())
     
-    def run_graph(question: str, chat_history: list):
-        df_head = df.head().to_string()
+    def run_graph(question: str, chat_history: list, rerun: str = None, replay: bool = False):
+        """
+        Executa o grafo para a pergunta.
+
+        Args:
+            question: A pergunta do usuário.
+            chat_history: O histórico da conversa (apenas `HumanMessage`/`AIMessage`, sem a pergunta atual).
+            rerun: 'executor' para reexecutar o código já gerado (e refazer a conclusão)
+                ou 'concluder' para refazer apenas a conclusão.
+            replay: Se a pergunta já tiver uma resposta concluída, a reproduz do checkpoint sem chamar o LLM.
+        """
+        config = {"configurable": {"thread_id": make_thread_id(session_id, question)}}
+        snapshot = app.get_state(config)
+
+        if rerun:
+            if not snapshot.values.get("step_results"):
+                raise ValueError("Não há código salvo para esta pergunta; não é possível reexecutar.")
+            return app.invoke({"rerun": rerun}, config)
+        if snapshot.next:
+            # A execução anterior foi interrompida (erro ou timeout): retoma a partir do nó que falhou
+            return app.invoke(None, config)
+        if replay and snapshot.values.get("conclusion"):
+            # Reprodução explícita de uma resposta já concluída, sem chamar o LLM
+            return snapshot.values
+
         inputs = {
             "question": question,
-            "df_head": df_head,
-            "chat_history": chat_history + [HumanMessage(content=question)]
+            "chat_history": chat_history + [HumanMessage(content=question)],
+            "rerun": None,
+            "step_results": None,  # Descarta as etapas de uma execução anterior desta pergunta
+            # Sem ramo de recuperação (sessão sem PDFs), nada sobrescreveria o contexto da execução anterior
+            "retrieved_context": ""
         }
-        return app.invoke(inputs)
+        return app.invoke(inputs, config)
 
     return run_graph
\ No newline at end of file
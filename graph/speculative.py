@@ -0,0 +1,118 @@
+# /graph/speculative.py
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable
+
+from tools.pandas_tool import is_execution_error
+
+# Pool compartilhado por todas as sessões, usado apenas com a geração especulativa ativa (candidatos > 1).
+# Limita quantos candidatos são gerados ao mesmo tempo; a execução em si é serializada pelo PythonExecutorTool.
+SPECULATIVE_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv("SPECULATIVE_MAX_WORKERS", 8)),
+    thread_name_prefix="speculative"
+)
+
+def _candidate_feedback(feedback: str, index: int, candidates: int) -> str:
+    """
+    Monta as instruções extras de um candidato. O primeiro usa o prompt original; os demais pedem
+    abordagens diferentes, o que diversifica os scripts (e evita que o gateway agrupe prompts idênticos).
+    """
+    if index == 0:
+        return feedback
+    hint = (
+        f"**--- CANDIDATO {index + 1} DE {candidates} ---**\n"
+        "Outros scripts estão sendo gerados em paralelo para este mesmo plano. "
+        "Use uma implementação diferente da mais óbvia (outras funções do pandas, numpy ou seaborn), "
+        "mantendo todas as regras acima."
+    )
+    return f"{feedback}\n\n{hint}" if feedback else hint
+
+def _repair_feedback(code: str, error: str) -> str:
+    """Instruções para a rodada de correção, com o script que falhou e o erro obtido."""
+    return (
+        "**--- TENTATIVA ANTERIOR (FALHOU) ---**\n"
+        "O script abaixo falhou. Corrija a causa do erro e gere novamente o script completo.\n"
+        f"Script:\n```python\n{code}\n```\n"
+        f"Erro:\n{error}"
+    )
+
+def _attempt(generate: Callable[[str], str], execute: Callable[[str], str], feedback: str, cancelled: threading.Event):
+    code = generate(feedback)
+    # Outro candidato já venceu enquanto este gerava: não executa (nem disputa o lock de execução)
+    if cancelled.is_set():
+        return None
+    return {"code": code, "result": execute(code)}
+
+def _run_round(generate: Callable[[str], str], execute: Callable[[str], str], feedback: str, candidates: int):
+    """
+    Executa uma rodada e devolve `(vencedor, falhas)`. Com um único candidato a tentativa roda
+    na própria thread, sem ocupar o pool; o pool só é usado quando a geração especulativa está ativa.
+    """
+    cancelled = threading.Event()
+    if candidates == 1:
+        attempt = _attempt(generate, execute, feedback, cancelled)
+        return (attempt, []) if not is_execution_error(attempt["result"]) else (None, [attempt])
+
+    futures = [
+        SPECULATIVE_POOL.submit(_attempt, generate, execute, _candidate_feedback(feedback, i, candidates), cancelled)
+        for i in range(candidates)
+    ]
+    failures = []
+    first_error = None
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                attempt = future.result()
+            except Exception as e:
+                first_error = first_error or e
+                continue
+            if not is_execution_error(attempt["result"]):
+                cancelled.set()
+                for other in pending:
+                    other.cancel()
+                return attempt, failures
+            failures.append(attempt)
+
+    # Nenhum candidato chegou a gerar código (ex: falha do provedor de LLM): não há o que corrigir
+    if not failures:
+        raise first_error
+    return None, failures
+
+def generate_and_execute(
+    generate: Callable[[str], str],
+    execute: Callable[[str], str],
+    candidates: int = 1,
+    max_repairs: int = 0,
+) -> dict:
+    """
+    Gera `candidates` scripts em paralelo e devolve o primeiro que executar com sucesso.
+    Se todos falharem, o erro do primeiro a falhar é enviado de volta ao gerador, por até `max_repairs` rodadas.
+
+    Limitações: apenas a geração (chamadas ao LLM) é paralela. A execução dos candidatos é serializada
+    pelo lock global do `PythonExecutorTool` e não pode ser interrompida. Quando um candidato vence, os que
+    ainda não começaram são cancelados e os que ainda estão gerando código deixam de executá-lo, mas um
+    candidato já em execução roda até o fim e seu resultado é descartado (ele opera sobre uma cópia do
+    DataFrame, então não altera os dados das demais execuções).
+
+    Args:
+        generate: Recebe as instruções extras (candidato/correção) e devolve o código gerado.
+        execute: Executa o código e devolve o resultado textual da ferramenta.
+        candidates: Número de scripts gerados por rodada (1 desativa a geração especulativa).
+        max_repairs: Número máximo de rodadas de correção após a primeira.
+
+    Returns:
+        dict: O `code` e o `result` do candidato escolhido (ou da última falha).
+    """
+    feedback = ""
+    last_failure = None
+    for _ in range(max_repairs + 1):
+        winner, failures = _run_round(generate, execute, feedback, candidates)
+        if winner:
+            return winner
+        last_failure = failures[0]
+        feedback = _repair_feedback(last_failure["code"], last_failure["result"])
+    return last_failure
@@ -1,10 +1,21 @@
 # /graph/state.py
 
-from typing import TypedDict, List, Annotated
-import operator
+from typing import TypedDict, List, Annotated, Optional
 import pandas as pd
 from langchain_core.messages import BaseMessage
 
+def merge_step_results(left: List[dict], right: List[dict]) -> List[dict]:
+    """
+    Junta os resultados das etapas vindos de ramos paralelos.
+    Um resultado com o mesmo `id` de outro já existente o substitui (ex: ao reexecutar o código).
+    `None` limpa a lista: uma nova execução da mesma pergunta não herda etapas da anterior.
+    """
+    if right is None:
+        return []
+    merged = {r["id"]: r for r in left or []}
+    merged.update({r["id"]: r for r in right or []})
+    return sorted(merged.values(), key=lambda r: r["id"])
+
 class EdaGraphState(TypedDict):
     """
     Representa o estado do nosso grafo de análise.
@@ -12,19 +23,29 @@ class EdaGraphState(TypedDict):
     Atributos:
         question: A pergunta original do usuário.
         df_head: As primeiras linhas do DataFrame para dar contexto ao LLM.
+        retrieved_context: Trechos dos PDFs do usuário relevantes para a pergunta (vazio se não houver).
         classification: A classificação da pergunta (ex: 'plot', 'descritivo').
-        plan: O plano de execução gerado pelo LLM.
+        plan: O plano de execução gerado pelo LLM (versão textual, exibida ao usuário).
+        plan_steps: As etapas estruturadas do plano, com suas dependências (DAG).
+        step_results: Código e resultado de cada etapa executada; acumula entre ramos paralelos.
+        rerun: Nó a partir do qual uma execução já concluída deve ser refeita ('executor' ou 'concluder').
         code_to_execute: O snippet de código Python gerado para a etapa atual.
         execution_result: O resultado (texto ou imagem base64) da execução do código.
         conclusion: A conclusão final gerada para o usuário.
-        chat_history: O histórico da conversa.
+        chat_history: O histórico da conversa até a pergunta atual (inclusive).
     """
     question: str
     df_head: str
+    retrieved_context: str
     classification: str
     plan: str
+    plan_steps: List[dict]
+    # Cada ramo paralelo devolve uma lista com o próprio resultado; o redutor junta todos por `id`
+    step_results: Annotated[List[dict], merge_step_results]
+    rerun: Optional[str]
     code_to_execute: str
     execution_result: str
     conclusion: str
-    # A anotação permite que a chave `chat_history` acumule mensagens
-    chat_history: Annotated[List[BaseMessage], operator.add]
\ No newline at end of file
+    # Sem redutor: cada execução nova recebe o histórico completo e substitui o salvo no checkpoint,
+    # de modo que repetir uma pergunta (mesmo checkpoint) não duplica a conversa
+    chat_history: List[BaseMessage]
\ No newline at end of file
@@ -3,6 +3,7 @@
 from langchain_openai import ChatOpenAI
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.language_models.chat_models import BaseChatModel
+from llm.llm_gateway import LLMGateway
 from dotenv import load_dotenv
 import os
 import streamlit as st
@@ -13,9 +14,11 @@ class LLMFactory:
     """
     Fábrica responsável por criar instâncias de modelos de linguagem (LLMs).
     Utiliza o Factory Pattern para desacoplar a criação de LLMs do resto da aplicação.
+    Todo modelo criado é envolvido pelo `LLMGateway`, que controla taxa, novas tentativas
+    e agrupamento de requisições de forma compartilhada por provedor.
     """
     @staticmethod
-    def create_llm(provider: str, api_key: str = None) -> BaseChatModel:
+    def create_llm(provider: str, api_key: str = None) -> LLMGateway:
         """
         Cria e retorna uma instância de um LLM com base no provedor especificado.
 
@@ -24,11 +27,20 @@ class LLMFactory:
             api_key (str, optional): A chave de API para o serviço.
 
         Returns:
-            BaseChatModel: Uma instância do modelo de chat.
+            LLMGateway: O modelo de chat envolvido pelo gateway do provedor.
         
         Raises:
             ValueError: Se o provedor for desconhecido.
         """
+        # Sem chave informada, a sessão usa a chave do ambiente, comum a todas as sessões
+        return LLMGateway(LLMFactory._create_base_llm(provider, api_key), provider, credentials=api_key)
+
+    @staticmethod
+    def _create_base_llm(provider: str, api_key: str = None) -> BaseChatModel:
+        """
+        Cria o modelo de chat do provedor, sem o gateway.
+        As novas tentativas dos clientes ficam desligadas (`max_retries=0`), pois são feitas pelo gateway.
+        """
         if provider.upper() == 'GEMINI':
             key = api_key or os.getenv("GOOGLE_API_KEY")
             if not key:
@@ -60,7 +72,7 @@ class LLMFactory:
             models/embedding-001
             models/text-embedding-004
             """
-            return ChatGoogleGenerativeAI(google_api_key=key, temperature=0, model="gemini-2.5-pro", convert_system_message_to_human=True)
+            return ChatGoogleGenerativeAI(google_api_key=key, temperature=0, model="gemini-2.5-pro", convert_system_message_to_human=True, max_retries=0)
         
         elif provider.upper() == 'GPT':
             key = api_key or os.getenv("OPENAI_API_KEY")
@@ -72,14 +84,16 @@ class LLMFactory:
                     pass
             if not key:
                 raise ValueError("Chave de API da OpenAI não encontrada.")
-            return ChatOpenAI(api_key=key, temperature=0, model_name="gpt-4")
+            return ChatOpenAI(api_key=key, temperature=0, model_name="gpt-4", max_retries=0)
 
         elif provider.upper() == 'LOCALLM':
             # Exemplo para um LLM local (Ollama) servido via API compatível com OpenAI
+            # O endpoint pode ser trocado via LOCALLM_BASE_URL (ex: um servidor stub para testes)
             return ChatOpenAI(
-                base_url="http://localhost:11434/v1",
+                base_url=os.getenv("LOCALLM_BASE_URL", "http://localhost:11434/v1"),
                 api_key="ollama", # A API key pode ser qualquer string para Ollama
-                model_name="gpt-oss:20b" # Nome do modelo que você está servindo
+                model_name="gpt-oss:20b", # Nome do modelo que você está servindo
+                max_retries=0
             )
         
         else:
@@ -0,0 +1,257 @@
+# /llm/llm_gateway.py
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Optional
+
+from langchain_core.language_models import LanguageModelInput
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig
+
+# Limites padrão por provedor: requisições (rpm) e tokens (tpm) por minuto.
+# Podem ser sobrescritos por variáveis de ambiente, ex: GEMINI_RPM=30, GPT_TPM=40000.
+DEFAULT_PROVIDER_LIMITS = {
+    "GEMINI": {"rpm": 60, "tpm": 1_000_000},
+    "GPT": {"rpm": 500, "tpm": 30_000},
+    "LOCALLM": {"rpm": 120, "tpm": 1_000_000},
+}
+
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 30.0
+
+# Códigos HTTP considerados transitórios (limite de taxa, timeout ou indisponibilidade do provedor)
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_ERROR_MARKERS = (
+    "RateLimit", "ResourceExhausted", "ServiceUnavailable", "Timeout",
+    "APIConnection", "InternalServerError", "DeadlineExceeded",
+)
+
+
+class LLMGatewayError(Exception):
+    """Exceção levantada quando uma chamada ao LLM falha de forma definitiva no gateway."""
+    pass
+
+
+class TokenBucket:
+    """
+    Balde de tokens thread-safe. Reabastece continuamente até a capacidade máxima
+    e bloqueia o chamador até que haja saldo suficiente.
+    """
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.refill_per_second)
+        self._updated_at = now
+
+    def acquire(self, amount: float) -> float:
+        """Consome `amount` tokens, esperando se necessário. Retorna o tempo total de espera em segundos."""
+        # Uma requisição maior que o balde nunca caberia; limita à capacidade para não travar
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return waited
+                wait = (amount - self._tokens) / self.refill_per_second
+            time.sleep(wait)
+            waited += wait
+
+    def debit(self, amount: float):
+        """Desconta tokens já consumidos (ex: tokens de saída); o saldo pode ficar negativo."""
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+
+
+class _ProviderState:
+    """Estado compartilhado por todas as sessões que usam o mesmo provedor."""
+    def __init__(self, provider: str):
+        limits = DEFAULT_PROVIDER_LIMITS.get(provider, DEFAULT_PROVIDER_LIMITS["LOCALLM"])
+        rpm = float(os.getenv(f"{provider}_RPM", limits["rpm"]))
+        tpm = float(os.getenv(f"{provider}_TPM", limits["tpm"]))
+        self.request_bucket = TokenBucket(rpm, rpm / 60)
+        self.token_bucket = TokenBucket(tpm, tpm / 60)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.metrics = {
+            "requests": 0,
+            "llm_calls": 0,
+            "coalesced": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "failures": 0,
+            "throttle_wait_seconds": 0.0,
+            "tokens": 0,
+        }
+
+    def incr(self, metric: str, amount=1):
+        with self.lock:
+            self.metrics[metric] += amount
+
+
+_PROVIDER_STATES = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def _get_provider_state(provider: str) -> _ProviderState:
+    with _REGISTRY_LOCK:
+        if provider not in _PROVIDER_STATES:
+            _PROVIDER_STATES[provider] = _ProviderState(provider)
+        return _PROVIDER_STATES[provider]
+
+
+def get_gateway_metrics() -> dict:
+    """Retorna uma cópia das métricas acumuladas de cada provedor."""
+    with _REGISTRY_LOCK:
+        states = dict(_PROVIDER_STATES)
+    metrics = {}
+    for provider, state in states.items():
+        with state.lock:
+            metrics[provider] = dict(state.metrics, in_flight=len(state.in_flight))
+    return metrics
+
+
+def _input_to_text(input: LanguageModelInput) -> str:
+    if isinstance(input, PromptValue):
+        return input.to_string()
+    if isinstance(input, str):
+        return input
+    return "\n".join(f"{getattr(m, 'type', '')}: {getattr(m, 'content', m)}" for m in input)
+
+
+def _estimate_tokens(text: str) -> int:
+    # Aproximação grosseira (~4 caracteres por token), suficiente para o controle de taxa
+    return len(text) // 4 + 1
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    for candidate in (error, getattr(error, "response", None)):
+        for attr in ("status_code", "code"):
+            value = getattr(candidate, attr, None)
+            if isinstance(value, int):
+                return value
+    return None
+
+
+def _is_rate_limit(error: Exception) -> bool:
+    name = type(error).__name__
+    return _status_code(error) == 429 or "RateLimit" in name or "ResourceExhausted" in name
+
+
+def _is_retryable(error: Exception) -> bool:
+    if _status_code(error) in RETRYABLE_STATUS_CODES:
+        return True
+    name = type(error).__name__
+    return any(marker in name for marker in RETRYABLE_ERROR_MARKERS)
+
+
+def _backoff_delay(attempt: int, error: Exception) -> float:
+    """Backoff exponencial com jitter completo; respeita o cabeçalho Retry-After quando presente."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        retry_after = float(headers.get("retry-after"))
+    except (TypeError, ValueError, AttributeError):
+        retry_after = None
+    if retry_after is not None:
+        return min(retry_after, BACKOFF_MAX_SECONDS)
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+class LLMGateway(Runnable[LanguageModelInput, BaseMessage]):
+    """
+    Camada compartilhada em volta dos modelos criados pelo `LLMFactory`.
+    Aplica limites de requisições e tokens por provedor (token bucket), novas tentativas com
+    backoff exponencial e jitter, e agrupa requisições idênticas em andamento em uma única chamada.
+    Por ser um `Runnable`, pode ser composto normalmente com prompts (`prompt | llm`).
+    """
+    def __init__(self, llm: BaseChatModel, provider: str, credentials: Optional[str] = None):
+        self.llm = llm
+        self.provider = provider.upper()
+        # Só a impressão digital da chave é guardada; requisições só são agrupadas entre as mesmas credenciais,
+        # para que um erro de uma chave inválida (401, cota) nunca chegue a uma sessão com chave válida.
+        self._credentials_id = hashlib.sha256((credentials or "").encode("utf-8")).hexdigest()
+        self._state = _get_provider_state(self.provider)
+
+    def _request_key(self, input: LanguageModelInput, kwargs: dict) -> str:
+        model_params = json.dumps(getattr(self.llm, "_identifying_params", {}), sort_keys=True, default=str)
+        payload = json.dumps(
+            [self.provider, self._credentials_id, model_params, _input_to_text(input), kwargs],
+            sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def invoke(self, input: LanguageModelInput, config: Optional[RunnableConfig] = None, **kwargs: Any) -> BaseMessage:
+        state = self._state
+        key = self._request_key(input, kwargs)
+
+        with state.lock:
+            state.metrics["requests"] += 1
+            future = state.in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                state.in_flight[key] = future
+            else:
+                state.metrics["coalesced"] += 1
+
+        # Uma requisição idêntica já está em andamento: aguarda e compartilha a mesma resposta
+        if not is_leader:
+            return future.result()
+
+        try:
+            response = self._invoke_with_retry(input, config, **kwargs)
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            # Inclui interrupções (ex: rerun do Streamlit) para nunca deixar os agrupados esperando
+            future.set_exception(e)
+            raise
+        finally:
+            with state.lock:
+                state.in_flight.pop(key, None)
+
+    def _invoke_with_retry(self, input: LanguageModelInput, config: Optional[RunnableConfig], **kwargs: Any) -> BaseMessage:
+        state = self._state
+        prompt_tokens = _estimate_tokens(_input_to_text(input))
+
+        for attempt in range(MAX_RETRIES + 1):
+            waited = state.request_bucket.acquire(1) + state.token_bucket.acquire(prompt_tokens)
+            state.incr("throttle_wait_seconds", waited)
+            state.incr("llm_calls")
+            try:
+                response = self.llm.invoke(input, config, **kwargs)
+            except Exception as e:
+                if _is_rate_limit(e):
+                    state.incr("rate_limited")
+                if not _is_retryable(e) or attempt == MAX_RETRIES:
+                    state.incr("failures")
+                    raise LLMGatewayError(
+                        f"Falha na chamada ao provedor {self.provider} após {attempt + 1} tentativa(s): "
+                        f"{type(e).__name__} - {e}"
+                    ) from e
+                state.incr("retries")
+                time.sleep(_backoff_delay(attempt, e))
+                continue
+
+            # Os tokens de saída só são conhecidos após a resposta; são descontados do balde agora
+            usage = getattr(response, "usage_metadata", None) or {}
+            output_tokens = usage.get("output_tokens") or _estimate_tokens(str(response.content))
+            state.token_bucket.debit(output_tokens)
+            state.incr("tokens", prompt_tokens + output_tokens)
+            return response
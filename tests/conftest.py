@@ -0,0 +1,7 @@
+# /tests/conftest.py
+
+import os
+import sys
+
+# Os módulos da aplicação são importados a partir da raiz do projeto (ex: `from graph.eda_graph import ...`)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
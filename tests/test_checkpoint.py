@@ -0,0 +1,119 @@
+# /tests/test_checkpoint.py
+
+import json
+
+import pandas as pd
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.runnables import RunnableLambda
+
+from graph import checkpoint
+from graph.eda_graph import create_eda_graph
+
+
+class FakeLLM:
+    """LLM falso que conta as chamadas por tipo de prompt e pode falhar na conclusão."""
+    def __init__(self, steps):
+        self.steps = steps
+        self.calls = {"planner": 0, "code": 0, "concluder": 0}
+        self.fail_conclusion = False
+
+    def __call__(self, prompt):
+        text = prompt.to_string()
+        if "Plano (JSON)" in text:
+            self.calls["planner"] += 1
+            return AIMessage(content=json.dumps({"etapas": [
+                {"id": i + 1, "descricao": d, "depende_de": []} for i, d in enumerate(self.steps)
+            ]}))
+        if "SCRIPT PYTHON" in text:
+            self.calls["code"] += 1
+            return AIMessage(content="```python\nresult_data = len(df)\n```")
+        self.calls["concluder"] += 1
+        if self.fail_conclusion:
+            raise TimeoutError("concluder timeout")
+        return AIMessage(content=f"conclusão {self.calls['concluder']}")
+
+
+@pytest.fixture(autouse=True)
+def isolated_checkpoints(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkpoint, "CHECKPOINT_DB_PATH", str(tmp_path / "checkpoints.sqlite"))
+    monkeypatch.setattr(checkpoint, "_checkpointer", None)
+
+
+def _graph(fake, session_id="sessao"):
+    return create_eda_graph(RunnableLambda(fake), pd.DataFrame({"a": [1, 2, 3]}), session_id=session_id)
+
+
+def test_resumes_from_failed_concluder_without_replanning():
+    fake = FakeLLM(["contagem"])
+    run_graph = _graph(fake)
+    fake.fail_conclusion = True
+    with pytest.raises(TimeoutError):
+        run_graph("quantas linhas?", [])
+
+    fake.fail_conclusion = False
+    state = run_graph("quantas linhas?", [])
+
+    assert state["conclusion"] == "conclusão 2"
+    assert fake.calls == {"planner": 1, "code": 1, "concluder": 2}
+
+
+def test_resume_survives_a_new_graph_with_the_same_session():
+    fake = FakeLLM(["contagem"])
+    fake.fail_conclusion = True
+    with pytest.raises(TimeoutError):
+        _graph(fake)("quantas linhas?", [])
+
+    # Simula um novo "Iniciar Agente": um grafo novo, com o mesmo identificador de sessão
+    fake.fail_conclusion = False
+    state = _graph(fake)("quantas linhas?", [])
+    assert state["conclusion"] == "conclusão 2"
+    assert fake.calls["planner"] == 1
+
+
+def test_repeated_question_reruns_unless_replay_is_requested():
+    fake = FakeLLM(["contagem", "média"])
+    run_graph = _graph(fake)
+    run_graph("resuma", [])
+
+    replayed = run_graph("resuma", [], replay=True)
+    assert replayed["conclusion"] == "conclusão 1"
+    assert fake.calls["planner"] == 1
+
+    fake.steps = ["apenas uma etapa"]
+    fresh = run_graph("resuma", [])
+    assert fake.calls["planner"] == 2
+    assert fresh["conclusion"] == "conclusão 2"
+    # A nova execução não herda as etapas da anterior
+    assert [r["description"] for r in fresh["step_results"]] == ["apenas uma etapa"]
+
+
+def test_repeated_question_does_not_duplicate_history():
+    fake = FakeLLM(["contagem"])
+    run_graph = _graph(fake)
+    history = [HumanMessage(content="q0"), AIMessage(content="a0")]
+    first = run_graph("q", history)
+    assert [m.content for m in first["chat_history"]] == ["q0", "a0", "q"]
+
+    second = run_graph("q", history + [HumanMessage(content="q"), AIMessage(content="c")])
+    assert [m.content for m in second["chat_history"]] == ["q0", "a0", "q", "c", "q"]
+
+
+def test_rerun_concluder_only():
+    fake = FakeLLM(["contagem"])
+    run_graph = _graph(fake)
+    run_graph("quantas linhas?", [])
+
+    state = run_graph("quantas linhas?", [], rerun="concluder")
+    assert state["conclusion"] == "conclusão 2"
+    assert fake.calls == {"planner": 1, "code": 1, "concluder": 2}
+
+
+def test_delete_session_checkpoints_only_touches_that_session():
+    fake = FakeLLM(["contagem"])
+    _graph(fake, "sessao-a")("p1", [])
+    _graph(fake, "sessao-a")("p2", [])
+    _graph(fake, "sessao-ab")("p1", [])
+
+    assert checkpoint.delete_session_checkpoints("sessao-a") == 2
+    assert _graph(fake, "sessao-ab")("p1", [], replay=True)["conclusion"] == "conclusão 3"
@@ -0,0 +1,52 @@
+# /tests/test_eda_graph.py
+
+import json
+
+import pandas as pd
+
+from graph.eda_graph import _parse_plan_steps, _format_plan
+from tools.pandas_tool import PythonExecutorTool
+
+
+def test_parse_plan_steps_reads_json_dag():
+    raw = json.dumps({"etapas": [
+        {"id": 1, "descricao": "Distribuições", "depende_de": []},
+        {"id": 2, "descricao": "Correlações", "depende_de": []},
+        {"id": 3, "descricao": "Resumo", "depende_de": [1, 2]},
+    ]})
+    steps = _parse_plan_steps(raw)
+    assert [s["id"] for s in steps] == [1, 2, 3]
+    assert steps[2]["depends_on"] == [1, 2]
+    assert _format_plan(steps).splitlines()[2] == "3. Resumo (depende de: 1, 2)"
+
+
+def test_parse_plan_steps_accepts_markdown_and_renumbers_ids():
+    raw = '```json\n{"etapas": [{"id": "a", "descricao": "X"}, {"id": "b", "descricao": "Y", "depende_de": "a"}]}\n```'
+    steps = _parse_plan_steps(raw)
+    assert steps == [
+        {"id": 1, "description": "X", "depends_on": []},
+        {"id": 2, "description": "Y", "depends_on": [1]},
+    ]
+
+
+def test_parse_plan_steps_drops_forward_and_unknown_dependencies():
+    raw = json.dumps({"etapas": [
+        {"id": 1, "descricao": "A", "depende_de": [2]},
+        {"id": 2, "descricao": "B", "depende_de": [1, 99]},
+        {"id": 3, "descricao": "   "},
+    ]})
+    steps = _parse_plan_steps(raw)
+    assert [s["depends_on"] for s in steps] == [[], [1]]
+
+
+def test_parse_plan_steps_falls_back_to_single_step():
+    steps = _parse_plan_steps("1. Calcule a média\n2. Plote o histograma")
+    assert steps == [{"id": 1, "description": "1. Calcule a média\n2. Plote o histograma", "depends_on": []}]
+
+
+def test_executor_does_not_leak_inplace_mutations():
+    df = pd.DataFrame({"a": [1.0, None, 3.0]})
+    tool = PythonExecutorTool(df=df)
+    tool.invoke({"code": "df.dropna(inplace=True)\ndf['b'] = 1"})
+    assert tool.invoke({"code": "result_data = df.shape"}) == "(3, 1)"
+    assert df.shape == (3, 1)
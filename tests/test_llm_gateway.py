@@ -0,0 +1,163 @@
+# /tests/test_llm_gateway.py
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+from langchain_openai import ChatOpenAI
+
+from llm import llm_gateway
+from llm.llm_gateway import LLMGateway, LLMGatewayError, TokenBucket, get_gateway_metrics
+
+
+def _completion(content: str) -> dict:
+    return {
+        "id": "stub", "object": "chat.completion", "created": 0, "model": "stub",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 5, "completion_tokens": 3, "total_tokens": 8},
+    }
+
+
+class StubServer:
+    """Servidor HTTP local compatível com a API de chat da OpenAI, com respostas programáveis."""
+    def __init__(self):
+        self.responses = []  # (status, headers, body); a última é repetida quando a fila acaba
+        self.requests = []
+        self.delay = 0.0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                stub.requests.append({"body": body, "auth": self.headers.get("Authorization")})
+                time.sleep(stub.delay)
+                status, headers, payload = stub.responses.pop(0) if len(stub.responses) > 1 else stub.responses[0]
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def gateway(self, api_key: str = "stub-key", provider: str = "LOCALLM") -> LLMGateway:
+        llm = ChatOpenAI(base_url=self.base_url, api_key=api_key, model="stub", max_retries=0, timeout=10)
+        return LLMGateway(llm, provider, credentials=api_key)
+
+
+@pytest.fixture
+def stub():
+    server = StubServer()
+    yield server
+    server.server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def isolated_gateway(monkeypatch):
+    # Estado por provedor novo a cada teste e backoff sem espera real
+    monkeypatch.setattr(llm_gateway, "_PROVIDER_STATES", {})
+    monkeypatch.setattr(llm_gateway, "BACKOFF_BASE_SECONDS", 0.0)
+
+
+def test_retries_rate_limit_then_succeeds(stub):
+    stub.responses = [
+        (429, {"Retry-After": "0"}, {"error": {"message": "slow down", "type": "rate_limit"}}),
+        (200, {}, _completion("ok")),
+    ]
+    response = stub.gateway().invoke("olá")
+
+    assert response.content == "ok"
+    assert len(stub.requests) == 2
+    metrics = get_gateway_metrics()["LOCALLM"]
+    assert metrics["retries"] == 1
+    assert metrics["rate_limited"] == 1
+    assert metrics["failures"] == 0
+
+
+def test_non_retryable_error_is_wrapped_without_retry(stub):
+    stub.responses = [(401, {}, {"error": {"message": "invalid key", "type": "auth"}})]
+
+    with pytest.raises(LLMGatewayError, match="LOCALLM após 1 tentativa"):
+        stub.gateway().invoke("olá")
+    assert len(stub.requests) == 1
+    assert get_gateway_metrics()["LOCALLM"]["failures"] == 1
+
+
+def test_gives_up_after_max_retries(stub, monkeypatch):
+    monkeypatch.setattr(llm_gateway, "MAX_RETRIES", 2)
+    stub.responses = [(503, {}, {"error": {"message": "unavailable"}})]
+
+    with pytest.raises(LLMGatewayError, match="após 3 tentativa"):
+        stub.gateway().invoke("olá")
+    assert len(stub.requests) == 3
+
+
+def test_coalesces_identical_in_flight_requests(stub):
+    stub.delay = 0.3
+    stub.responses = [(200, {}, _completion("compartilhada"))]
+    gateway = stub.gateway()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(gateway.invoke("mesma pergunta"))) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert [r.content for r in results] == ["compartilhada"] * 3
+    assert len(stub.requests) == 1
+    assert get_gateway_metrics()["LOCALLM"]["coalesced"] == 2
+
+
+def test_does_not_coalesce_across_credentials(stub):
+    stub.delay = 0.3
+    stub.responses = [(200, {}, _completion("ok"))]
+    gateways = [stub.gateway(api_key="chave-a"), stub.gateway(api_key="chave-b")]
+    threads = [threading.Thread(target=g.invoke, args=("mesma pergunta",)) for g in gateways]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(r["auth"] for r in stub.requests) == ["Bearer chave-a", "Bearer chave-b"]
+    assert get_gateway_metrics()["LOCALLM"]["coalesced"] == 0
+
+
+def test_backoff_honours_retry_after_and_caps_jitter(monkeypatch):
+    error = SimpleNamespace(response=SimpleNamespace(headers={"retry-after": "2"}))
+    assert llm_gateway._backoff_delay(0, error) == 2.0
+
+    monkeypatch.setattr(llm_gateway, "BACKOFF_BASE_SECONDS", 1.0)
+    delays = [llm_gateway._backoff_delay(3, Exception()) for _ in range(50)]
+    assert all(0 <= d <= 8 for d in delays)
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(capacity=2, refill_per_second=20)
+    assert bucket.acquire(2) == 0.0
+
+    started = time.monotonic()
+    waited = bucket.acquire(1)
+    assert waited > 0
+    assert time.monotonic() - started >= 0.04
+
+
+def test_request_bucket_throttles_calls(stub):
+    stub.responses = [(200, {}, _completion("ok"))]
+    gateway = stub.gateway()
+    gateway._state.request_bucket = TokenBucket(capacity=1, refill_per_second=10)
+
+    gateway.invoke("primeira")
+    gateway.invoke("segunda")
+
+    assert get_gateway_metrics()["LOCALLM"]["throttle_wait_seconds"] > 0
@@ -0,0 +1,134 @@
+# /tests/test_rag_tool.py
+
+import chromadb
+import pandas as pd
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+from graph import checkpoint, eda_graph
+from tools import rag_tool
+
+
+@pytest.fixture(autouse=True)
+def isolated_vectorstore(tmp_path, monkeypatch):
+    monkeypatch.setattr(rag_tool, "VECTORSTORE_DIR", str(tmp_path / "vectorstore_db"))
+    monkeypatch.setattr(rag_tool, "_bm25_cache", {})
+    monkeypatch.setattr(rag_tool, "_vectorstores", {})
+    # Sem chave da OpenAI: a busca vetorial falha e só o BM25 está disponível
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+
+
+def _add_collection(name: str, texts: list):
+    """Cria uma coleção com vetores fixos, sem depender de um modelo de embeddings."""
+    client = chromadb.PersistentClient(path=rag_tool.VECTORSTORE_DIR)
+    collection = client.get_or_create_collection(name, embedding_function=None)
+    collection.add(
+        ids=[f"{name}-{i}" for i in range(len(texts))],
+        documents=texts,
+        embeddings=[[float(i), 1.0] for i in range(len(texts))],
+        metadatas=[{"source": f"{name}.pdf", "page": i} for i in range(len(texts))],
+    )
+
+
+def test_hybrid_search_falls_back_to_bm25_without_embeddings_key():
+    _add_collection("kb-sessao-a", [
+        "A taxa de churn mede a proporção de clientes que cancelam o contrato.",
+        "O faturamento mensal é consolidado no fechamento contábil.",
+    ])
+
+    docs = rag_tool.hybrid_search("o que é churn de clientes?", "kb-sessao-a")
+
+    assert "churn" in docs[0].page_content
+    assert docs[0].metadata["source"] == "kb-sessao-a.pdf"
+    # O índice BM25 fica em cache mesmo sem embeddings; a busca vetorial não é guardada
+    assert "kb-sessao-a" in rag_tool._bm25_cache
+    assert rag_tool._vectorstores == {}
+
+
+def test_search_is_scoped_to_the_session_collection():
+    _add_collection("kb-sessao-a", ["A taxa de churn mede clientes que cancelam o contrato."])
+    _add_collection("kb-sessao-b", ["O churn de fornecedores é calculado trimestralmente."])
+
+    docs = rag_tool.hybrid_search("churn", "kb-sessao-a")
+
+    assert [d.metadata["source"] for d in docs] == ["kb-sessao-a.pdf"]
+    assert not rag_tool.is_retrieval_relevant("churn", "kb-sessao-sem-pdfs")
+    assert rag_tool.hybrid_search("churn", "kb-sessao-sem-pdfs") == []
+
+
+@pytest.mark.parametrize("chunks", [1, 2, 10])
+def test_related_question_passes_the_gate_regardless_of_collection_size(chunks):
+    _add_collection("kb-sessao-a", ["A taxa de churn mede a proporção de clientes que cancelam o contrato."] + [
+        f"Seção {i}: o faturamento mensal é consolidado no fechamento contábil." for i in range(chunks - 1)
+    ])
+
+    assert rag_tool.is_retrieval_relevant("qual a taxa de churn dos clientes?", "kb-sessao-a")
+    assert not rag_tool.is_retrieval_relevant("qual a média de idade por região?", "kb-sessao-a")
+
+
+def test_knowledge_base_id_depends_on_session_and_files():
+    class UploadedFile:
+        def __init__(self, name, data):
+            self.name, self._data = name, data
+
+        def getbuffer(self):
+            return memoryview(self._data)
+
+    pdfs = [UploadedFile("manual.pdf", b"%PDF-1")]
+    name = rag_tool.knowledge_base_id("aba:csv:GPT", pdfs)
+
+    assert name == rag_tool.knowledge_base_id("aba:csv:GPT", pdfs)
+    assert name != rag_tool.knowledge_base_id("outra-aba:csv:GPT", pdfs)
+    assert name != rag_tool.knowledge_base_id("aba:csv:GPT", [UploadedFile("manual.pdf", b"%PDF-2")])
+    assert len(name) <= 63
+
+
+@pytest.fixture
+def isolated_checkpoints(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkpoint, "CHECKPOINT_DB_PATH", str(tmp_path / "checkpoints.sqlite"))
+    monkeypatch.setattr(checkpoint, "_checkpointer", None)
+
+
+class FakeLLM:
+    """LLM falso que guarda os prompts recebidos pelo planejador."""
+    def __init__(self):
+        self.planner_prompts = []
+
+    def __call__(self, prompt):
+        text = prompt.to_string()
+        if "Plano (JSON)" in text:
+            self.planner_prompts.append(text)
+            return AIMessage(content='{"etapas": [{"id": 1, "descricao": "contagem", "depende_de": []}]}')
+        if "SCRIPT PYTHON" in text:
+            return AIMessage(content="```python\nresult_data = len(df)\n```")
+        return AIMessage(content="conclusão")
+
+
+def _graph(fake, knowledge_base=None):
+    return eda_graph.create_eda_graph(
+        RunnableLambda(fake), pd.DataFrame({"a": [1, 2, 3]}), session_id="sessao", knowledge_base=knowledge_base
+    )
+
+
+@pytest.mark.parametrize("knowledge_base", [None, "kb-sessao-a"])
+def test_graph_only_retrieves_from_the_session_knowledge_base(knowledge_base, isolated_checkpoints, monkeypatch):
+    searched = []
+    monkeypatch.setattr(eda_graph, "is_retrieval_relevant", lambda query, name: searched.append(name) or False)
+
+    state = _graph(FakeLLM(), knowledge_base)("quantas linhas?", [])
+
+    assert state["conclusion"] == "conclusão"
+    assert searched == ([knowledge_base] if knowledge_base else [])
+
+
+def test_fresh_run_without_pdfs_drops_previous_context(isolated_checkpoints):
+    _add_collection("kb-sessao-a", ["A taxa de churn mede clientes que cancelam o contrato."])
+    fake = FakeLLM()
+    _graph(fake, "kb-sessao-a")("qual a taxa de churn dos clientes?", [])
+    assert "cancelam o contrato" in fake.planner_prompts[0]
+
+    # O agente é reiniciado sem PDFs, na mesma sessão: a pergunta repetida não usa o texto antigo
+    state = _graph(fake)("qual a taxa de churn dos clientes?", [])
+    assert state["retrieved_context"] == ""
+    assert "cancelam o contrato" not in fake.planner_prompts[1]
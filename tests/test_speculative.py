@@ -0,0 +1,62 @@
+# /tests/test_speculative.py
+
+import threading
+import time
+
+from graph import speculative
+from graph.speculative import generate_and_execute
+
+
+def _execute(code):
+    return "Erro de Execução: ValueError - falhou" if code == "ruim" else f"ok:{code}"
+
+
+def test_single_candidate_runs_inline_without_pool(monkeypatch):
+    monkeypatch.setattr(speculative, "SPECULATIVE_POOL", None)  # qualquer uso do pool quebraria o teste
+    caller = threading.current_thread()
+    threads = []
+
+    def generate(feedback):
+        threads.append(threading.current_thread())
+        return "bom"
+
+    assert generate_and_execute(generate, _execute) == {"code": "bom", "result": "ok:bom"}
+    assert threads == [caller]
+
+
+def test_first_success_wins_and_slow_losers_skip_execution():
+    executed = []
+
+    def generate(feedback):
+        if "CANDIDATO 2" in feedback:
+            return "bom"
+        time.sleep(0.3)  # candidatos lentos terminam de gerar depois do vencedor
+        return "lento"
+
+    def execute(code):
+        executed.append(code)
+        return _execute(code)
+
+    assert generate_and_execute(generate, execute, candidates=3) == {"code": "bom", "result": "ok:bom"}
+    time.sleep(0.5)
+    assert executed == ["bom"]
+
+
+def test_repair_round_receives_failed_code_and_error():
+    feedbacks = []
+
+    def generate(feedback):
+        feedbacks.append(feedback)
+        return "corrigido" if "TENTATIVA ANTERIOR" in feedback else "ruim"
+
+    result = generate_and_execute(generate, _execute, candidates=1, max_repairs=2)
+
+    assert result == {"code": "corrigido", "result": "ok:corrigido"}
+    assert len(feedbacks) == 2
+    assert "ruim" in feedbacks[1] and "ValueError - falhou" in feedbacks[1]
+
+
+def test_returns_last_failure_when_repairs_are_exhausted():
+    result = generate_and_execute(lambda feedback: "ruim", _execute, candidates=2, max_repairs=1)
+    assert result["code"] == "ruim"
+    assert result["result"].startswith("Erro de Execução")
@@ -2,6 +2,8 @@
 
 import pandas as pd
 import io
+import threading
+import traceback
 from contextlib import redirect_stdout
 from typing import Type, Any
 from langchain_core.tools import BaseTool
@@ -9,6 +11,29 @@ from pydantic import BaseModel, Field
 
 from utils.security import sanitize_code, SecurityException
 
+# `redirect_stdout` e o estado global do pyplot são compartilhados pelo processo inteiro.
+# Como as etapas do plano são executadas em ramos paralelos do grafo, o `exec` precisa ser serializado.
+_EXECUTION_LOCK = threading.Lock()
+
+# Prefixos das mensagens de falha devolvidas pela ferramenta
+ERROR_PREFIXES = ("Erro de Segurança:", "Erro de Execução:")
+
+def is_execution_error(result: str) -> bool:
+    """Indica se o resultado devolvido pela ferramenta representa uma falha."""
+    return str(result).startswith(ERROR_PREFIXES)
+
+def _format_code_traceback(error: Exception, code: str) -> str:
+    """Lista as linhas do código gerado envolvidas no erro, para que ele possa ser corrigido."""
+    code_lines = code.splitlines()
+    frames = [f for f in traceback.extract_tb(error.__traceback__) if f.filename == "<string>"]
+    lines = [
+        f"  linha {f.lineno}: {code_lines[f.lineno - 1].strip()}"
+        for f in frames if f.lineno and 0 < f.lineno <= len(code_lines)
+    ]
+    if not lines:
+        return ""
+    return "\nTraceback (código gerado):\n" + "\n".join(lines)
+
 class PythonExecutorTool(BaseTool):
     """
     Ferramenta segura para executar código Python para análise de dados com Pandas.
@@ -33,8 +58,10 @@ class PythonExecutorTool(BaseTool):
             sanitized_code = sanitize_code(code)
             
             # Prepara o ambiente de execução local com as bibliotecas permitidas
+            # Cada execução recebe uma cópia do DataFrame: etapas paralelas (e reexecuções) não
+            # enxergam as mutações in-place umas das outras, nem das perguntas anteriores.
             local_scope = {
-                'df': self.df,
+                'df': self.df.copy(),
                 'pd': pd,
                 'io': io
                 # Bibliotecas de plotagem serão importadas dentro do exec se necessário
@@ -42,7 +69,7 @@ class PythonExecutorTool(BaseTool):
             
             # Redireciona a saída padrão (prints) para uma string
             buffer = io.StringIO()
-            with redirect_stdout(buffer):
+            with _EXECUTION_LOCK, redirect_stdout(buffer):
                 exec(sanitized_code, globals(), local_scope)
             
             output_parts = []
@@ -95,7 +122,7 @@ class PythonExecutorTool(BaseTool):
         except SecurityException as e:
             return f"Erro de Segurança: {e}"
         except Exception as e:
-            return f"Erro de Execução: {type(e).__name__} - {e}"
+            return f"Erro de Execução: {type(e).__name__} - {e}{_format_code_traceback(e, code)}"
 
     def _arun(self, *args: Any, **kwargs: Any) -> Any:
         raise NotImplementedError("A execução assíncrona não é suportada por esta ferramenta.")
\ No newline at end of file
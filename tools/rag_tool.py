@@ -1,73 +1,241 @@
 # /tools/rag_tool.py
 
 import os
+import hashlib
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter
+from functools import lru_cache
+import chromadb
 import streamlit as st
 from langchain_chroma import Chroma
-from langchain_core.tools import tool
+from langchain_core.documents import Document
 from langchain_openai.embeddings import OpenAIEmbeddings
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 VECTORSTORE_DIR = "vectorstore_db"
 
+# Parâmetros da busca híbrida (BM25 + vetores)
+RETRIEVAL_K = 3
+CANDIDATES_PER_RETRIEVER = 10
+RRF_K = 60  # Constante da fusão por posição recíproca (Reciprocal Rank Fusion)
+# Fração mínima dos termos da pergunta presentes em um mesmo trecho para considerar que ela tem relação
+# com a base de conhecimento. Ao contrário da pontuação BM25, não depende do número de trechos da base.
+MIN_QUERY_COVERAGE = float(os.getenv("RAG_MIN_QUERY_COVERAGE", 0.5))
+# Modelo cross-encoder opcional para reordenar os trechos (requer `sentence-transformers`)
+RERANK_MODEL = os.getenv("RAG_RERANK_MODEL")
+
+STOPWORDS = {
+    "a", "o", "as", "os", "de", "da", "do", "das", "dos", "e", "em", "no", "na", "nos", "nas",
+    "um", "uma", "uns", "umas", "por", "para", "com", "sem", "que", "qual", "quais", "como",
+    "se", "ao", "aos", "mais", "menos", "ou", "sobre", "entre", "me", "meu", "minha", "seu", "sua",
+    "the", "of", "and", "to", "in", "is", "for", "on", "what", "which", "how",
+}
+
+def knowledge_base_id(session_id: str, pdf_files) -> str:
+    """
+    Nome da coleção do Chroma com os PDFs de uma sessão. Cada sessão (e cada conjunto de PDFs)
+    tem a sua coleção, de modo que documentos de outros usuários ou de execuções anteriores
+    nunca são recuperados.
+    """
+    digest = hashlib.sha256(session_id.encode("utf-8"))
+    for uploaded_file in pdf_files:
+        digest.update(uploaded_file.name.encode("utf-8"))
+        digest.update(uploaded_file.getbuffer())
+    return f"kb-{digest.hexdigest()[:40]}"
+
 @st.cache_resource
-def setup_vectorstore(pdf_files):
+def setup_vectorstore(pdf_files, collection_name: str):
     """
-    Cria e persiste um banco de dados vetorial a partir de arquivos PDF.
+    Cria e persiste a coleção vetorial da sessão a partir de arquivos PDF.
     Usa o cache do Streamlit para evitar recriar o banco a cada execução.
     """
     if not pdf_files:
         return None
-    
-    temp_dir = "temp_pdf_storage"
+    # A coleção já foi criada com estes mesmos PDFs (ex: antes de um reinício do servidor)
+    collection = _get_collection(collection_name)
+    if collection is not None and collection.count() > 0:
+        return collection_name
+
+    temp_dir = os.path.join("temp_pdf_storage", collection_name)
     if not os.path.exists(temp_dir):
         os.makedirs(temp_dir)
 
     # Salva arquivos temporariamente para o loader poder acessá-los
+    docs = []
     for uploaded_file in pdf_files:
         # with open(os.path.join(temp_dir, uploaded_file.name), "mb") as f:
-        with open(os.path.join(temp_dir, uploaded_file.name), "wb") as f:
+        path = os.path.join(temp_dir, uploaded_file.name)
+        with open(path, "wb") as f:
             f.write(uploaded_file.getbuffer())
-
-    # Carrega os documentos
-    docs = []
-    for file_name in os.listdir(temp_dir):
-        loader = PyPDFLoader(os.path.join(temp_dir, file_name))
-        docs.extend(loader.load())
+        # Carrega apenas os documentos enviados nesta sessão
+        docs.extend(PyPDFLoader(path).load())
 
     # Divide os documentos em chunks
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
     splits = text_splitter.split_documents(docs)
 
     # Cria o ChromaDB e o persiste
-    vectorstore = Chroma.from_documents(
+    Chroma.from_documents(
         documents=splits,
         embedding=OpenAIEmbeddings(),
+        collection_name=collection_name,
         persist_directory=VECTORSTORE_DIR
     )
-    return vectorstore
+    return collection_name
+
+def _tokenize(text: str) -> list:
+    """Minúsculas, sem acentos e sem stopwords, para que 'análise' e 'analise' coincidam."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [t for t in re.findall(r"\w+", text) if len(t) > 1 and t not in STOPWORDS]
+
+class BM25Index:
+    """Índice lexical BM25 em memória sobre os trechos armazenados no Chroma."""
+    def __init__(self, docs: list, k1: float = 1.5, b: float = 0.75):
+        self.docs = docs
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = [Counter(_tokenize(doc.page_content)) for doc in docs]
+        self.doc_lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = (sum(self.doc_lengths) / len(docs)) if docs else 0
+        doc_freqs = Counter(term for tf in self.term_freqs for term in tf)
+        self.idf = {
+            term: math.log((len(docs) - freq + 0.5) / (freq + 0.5) + 1)
+            for term, freq in doc_freqs.items()
+        }
+
+    def search(self, query: str, k: int) -> list:
+        """Retorna até `k` pares (documento, pontuação) com pontuação positiva, do maior para o menor."""
+        terms = [t for t in set(_tokenize(query)) if t in self.idf]
+        if not terms:
+            return []
+        scored = []
+        for doc, tf, length in zip(self.docs, self.term_freqs, self.doc_lengths):
+            score = 0.0
+            for term in terms:
+                freq = tf.get(term, 0)
+                if freq:
+                    norm = self.k1 * (1 - self.b + self.b * length / self.avg_length)
+                    score += self.idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            if score > 0:
+                scored.append((doc, score))
+        scored.sort(key=lambda pair: pair[1], reverse=True)
+        return scored[:k]
+
+    def coverage(self, query: str) -> float:
+        """Maior fração dos termos (distintos) da pergunta encontrados em um único trecho, entre 0 e 1."""
+        terms = set(_tokenize(query))
+        if not terms:
+            return 0.0
+        return max((len(terms & tf.keys()) / len(terms) for tf in self.term_freqs), default=0.0)
+
+_bm25_cache = {}  # coleção -> (número de trechos, índice BM25)
+_vectorstores = {}
+_index_lock = threading.Lock()
+
+def _get_collection(collection_name: str):
+    """Abre a coleção sem função de embeddings (basta para ler os trechos); None se não existir."""
+    if not os.path.exists(VECTORSTORE_DIR):
+        return None
+    client = chromadb.PersistentClient(path=VECTORSTORE_DIR)
+    try:
+        return client.get_collection(collection_name, embedding_function=None)
+    except chromadb.errors.NotFoundError:
+        return None
 
-@tool
-def knowledge_base_search(query: str) -> str:
+def _get_vectorstore(collection_name: str) -> Chroma:
     """
-    Use esta ferramenta para responder perguntas que necessitam de conhecimento externo
-    ou teórico sobre análise de dados, estatística ou o domínio do problema.
-    A entrada deve ser uma pergunta clara sobre o tópico que você precisa pesquisar.
+    Abre a coleção com os embeddings da OpenAI, apenas para a busca vetorial.
+    Criada sob demanda: sem chave da OpenAI, só esta etapa falha e o BM25 continua funcionando.
     """
-    if not os.path.exists(VECTORSTORE_DIR):
-        return "A base de conhecimento não foi inicializada. Não é possível pesquisar."
-    
-    vectorstore = Chroma(
-        persist_directory=VECTORSTORE_DIR,
-        embedding_function=OpenAIEmbeddings()
-    )
-    # retriever = vectorstore.as_retriever()
-    # Buscando metadados da fonte
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
-    docs = retriever.invoke(query)
-    
-    # context = "\n\n".join([doc.page_content for doc in docs])
-    # Formatando a saíde com a fonte de dados
+    with _index_lock:
+        if collection_name not in _vectorstores:
+            _vectorstores[collection_name] = Chroma(
+                collection_name=collection_name,
+                persist_directory=VECTORSTORE_DIR,
+                embedding_function=OpenAIEmbeddings()
+            )
+        return _vectorstores[collection_name]
+
+def get_bm25_index(collection_name: str):
+    """
+    Retorna o índice BM25 da coleção da sessão, ou None se ela não existir.
+    O índice é construído a partir dos trechos do Chroma, sem embeddings, e reconstruído
+    apenas quando o número de trechos da coleção muda.
+    """
+    collection = _get_collection(collection_name)
+    if collection is None:
+        return None
+    count = collection.count()
+
+    with _index_lock:
+        cached = _bm25_cache.get(collection_name)
+        if cached is None or cached[0] != count:
+            stored = collection.get(include=["documents", "metadatas"])
+            docs = [
+                Document(page_content=content, metadata=metadata or {})
+                for content, metadata in zip(stored["documents"], stored["metadatas"])
+            ]
+            cached = (count, BM25Index(docs))
+            _bm25_cache[collection_name] = cached
+        return cached[1]
+
+def is_retrieval_relevant(query: str, collection_name: str) -> bool:
+    """
+    Verificação barata (sem LLM e sem embeddings) de que a pergunta tem relação com a base:
+    a coleção precisa existir e algum trecho precisa conter ao menos `MIN_QUERY_COVERAGE` dos termos da pergunta.
+    """
+    bm25 = get_bm25_index(collection_name)
+    if bm25 is None:
+        return False
+    return bm25.coverage(query) >= MIN_QUERY_COVERAGE
+
+@lru_cache(maxsize=1)
+def _get_reranker():
+    try:
+        from sentence_transformers import CrossEncoder
+    except ImportError:
+        return None
+    return CrossEncoder(RERANK_MODEL)
+
+def _rerank(query: str, docs: list) -> list:
+    """Reordena os trechos com um cross-encoder, se configurado e instalado; caso contrário, mantém a ordem."""
+    reranker = _get_reranker() if RERANK_MODEL and docs else None
+    if reranker is None:
+        return docs
+    scores = reranker.predict([(query, doc.page_content) for doc in docs])
+    return [doc for _, doc in sorted(zip(scores, docs), key=lambda pair: pair[0], reverse=True)]
+
+def hybrid_search(query: str, collection_name: str, k: int = RETRIEVAL_K) -> list:
+    """
+    Busca híbrida na coleção da sessão: combina os resultados do BM25 e da busca vetorial do
+    Chroma por Reciprocal Rank Fusion e, opcionalmente, reordena com um cross-encoder.
+    Se a busca vetorial falhar (ex: sem chave para os embeddings), usa apenas o BM25.
+    """
+    bm25 = get_bm25_index(collection_name)
+    if bm25 is None:
+        return []
+
+    rankings = [[doc for doc, _ in bm25.search(query, CANDIDATES_PER_RETRIEVER)]]
+    try:
+        rankings.append(_get_vectorstore(collection_name).similarity_search(query, k=CANDIDATES_PER_RETRIEVER))
+    except Exception:
+        pass
+
+    fused = {}
+    for ranking in rankings:
+        for position, doc in enumerate(ranking):
+            doc_score = fused.setdefault(doc.page_content, [doc, 0.0])
+            doc_score[1] += 1 / (RRF_K + position + 1)
+    candidates = [doc for doc, _ in sorted(fused.values(), key=lambda pair: pair[1], reverse=True)]
+    return _rerank(query, candidates[:CANDIDATES_PER_RETRIEVER])[:k]
+
+def format_context(docs: list) -> str:
+    """Formata os trechos encontrados com a fonte (arquivo e página) de cada um."""
     context = ""
     for doc in docs:
         # Extrair nome do arquivo
@@ -75,6 +243,4 @@ def knowledge_base_search(query: str) -> str:
         page = doc.metadata.get('page', 'N/A')
         context += f"Fonte: {source}, Página: {page}\n"
         context += f"Conteúdo: {doc.page_content}\n\n"
-    if not context:
-        return "Nenhum contexto relevante encontrado na base de conhecimento."
-    return f"Contexto encontrado na base de conhecimento:\n{context}"
\ No newline at end of file
+    return context